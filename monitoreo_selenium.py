@@ -9,32 +9,307 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from selenium.webdriver.chrome.service import Service
+import argparse
 import time
 import json
+import math
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import statistics
 import os
+import re
 import sys
+import urllib.request
+import urllib.error
+import uuid
 
 # Configuración
 URL_BASE = 'http://127.0.0.1:5000'
 INTERVALO_MONITOREO = 60  # segundos entre cada chequeo
+INTERVALO_MINIMO_MONITOREO = 10  # segundos, frecuencia máxima durante una degradación
 TIEMPO_MAX_CARGA = 5  # segundos
+UMBRAL_DEGRADACION = 2  # segundos, tiempo de carga a partir del cual se acelera el chequeo
+# Umbrales propios de chequeos con varias peticiones: un journey sano suma tres consultas
+# a BD y hasta 2 s de pago, así que superaría el umbral de una página sola en ~1/3 de los casos
+UMBRALES_DEGRADACION = {
+    "journey_checkout": TIEMPO_MAX_CARGA
+}
+TIMEOUT_HTTP = 10  # segundos por petición en los sondeos HTTP
+PRODUCTO_JOURNEY = 1  # producto usado por el journey sintético de checkout
+MAX_HISTORIAL = 500  # máximo de ciclos, alertas y tiempos de carga guardados en memoria
+INTERVALO_CHECKPOINT = 300  # segundos entre reportes parciales en modo daemon
+ARCHIVO_CHECKPOINT = 'reporte_monitoreo_daemon.json'
+# Chequeos que usan HTTP directo y no necesitan el navegador
+CHEQUEOS_HTTP = {"journey_checkout", "health"}
+
+# Evaluación estadística del health check (test secuencial de Wald sobre ráfagas)
+TAMANO_RAFAGA_HEALTH = 5  # sondeos concurrentes por ráfaga
+MAX_RAFAGAS_HEALTH = 4  # tope de ráfagas por evaluación, acota el volumen de sondeos
+TASA_FALLO_SANA = 0.05  # tasa de fallo esperada con el sistema sano
+TASA_FALLO_CAIDA = 0.5  # tasa de fallo que se considera caída
+ALFA_HEALTH = 0.05  # probabilidad aceptada de falsa alarma
+BETA_HEALTH = 0.05  # probabilidad aceptada de no detectar una caída
+CONFIRMACIONES_HEALTH = 2  # decisiones consecutivas necesarias para cambiar de estado
+
+# Presupuestos de peso de página por chequeo (bytes transferidos, peticiones, bloqueo en ms)
+PRESUPUESTOS_PAGINA = {
+    "disponibilidad": {"bytes": 150_000, "peticiones": 15, "bloqueo_ms": 200},
+    "busqueda": {"bytes": 200_000, "peticiones": 20, "bloqueo_ms": 200},
+    "carrito": {"bytes": 100_000, "peticiones": 10, "bloqueo_ms": 200},
+    "checkout": {"bytes": 100_000, "peticiones": 10, "bloqueo_ms": 200}
+}
+TOLERANCIA_REGRESION_PESO = 0.2  # crecimiento sobre la línea base que se alerta como regresión
+MUESTRAS_LINEA_BASE_PESO = 20  # mediciones usadas para la línea base (mediana)
+
+
+def parsear_server_timing(header):
+    """Convierte un header Server-Timing ('bd;dur=12.3, total;dur=20.1') a {fase: segundos}"""
+    fases = {}
+    for metrica in (header or "").split(","):
+        partes = [p.strip() for p in metrica.split(";")]
+        if not partes[0]:
+            continue
+        duracion = 0.0
+        for parametro in partes[1:]:
+            if parametro.startswith("dur="):
+                try:
+                    duracion = float(parametro[4:]) / 1000
+                except ValueError:
+                    pass
+        fases[partes[0]] = duracion
+    return fases
+
+
+class ControladorFrecuencia:
+    """Ajusta el intervalo de cada chequeo según su estado.
+    
+    Ante errores el chequeo pasa directamente al intervalo mínimo; ante lentitud
+    el intervalo se reduce a la mitad. Cuando el chequeo vuelve a estar sano el
+    intervalo se duplica en cada ciclo hasta recuperar el intervalo base, de modo
+    que en estado estable el costo de sondeo es el mismo que con un intervalo fijo.
+    """
+    
+    def __init__(self, chequeos, intervalo_base=INTERVALO_MONITOREO,
+                 intervalo_minimo=INTERVALO_MINIMO_MONITOREO, umbral=UMBRAL_DEGRADACION,
+                 umbrales=None):
+        self.intervalo_base = intervalo_base
+        self.intervalo_minimo = intervalo_minimo
+        self.umbral = umbral
+        self.umbrales = UMBRALES_DEGRADACION if umbrales is None else umbrales
+        self.intervalos = {chequeo: intervalo_base for chequeo in chequeos}
+        inicio = time.monotonic()
+        self.proximo = {chequeo: inicio for chequeo in chequeos}  # time.monotonic()
+    
+    def registrar(self, chequeo, resultado, ahora):
+        """Actualiza el intervalo del chequeo según su último resultado"""
+        intervalo = self.intervalos[chequeo]
+        
+        if resultado.get("estado") in ["ERROR", "DOWN"]:
+            intervalo = self.intervalo_minimo
+        elif (resultado.get("estado") not in ("OK", "UP")
+              or resultado.get("tiempo_carga", 0) > self.umbrales.get(chequeo, self.umbral)):
+            intervalo = max(self.intervalo_minimo, intervalo / 2)
+        else:
+            intervalo = min(self.intervalo_base, intervalo * 2)
+        
+        self.intervalos[chequeo] = intervalo
+        self.proximo[chequeo] = ahora + intervalo
+        return intervalo
+    
+    def chequeos_pendientes(self, ahora):
+        """Chequeos cuyo próximo sondeo ya venció"""
+        return [chequeo for chequeo, instante in self.proximo.items() if instante <= ahora]
+    
+    def espera_siguiente(self, ahora):
+        """Segundos hasta el próximo chequeo pendiente"""
+        return max(0.0, min(self.proximo.values()) - ahora)
+    
+    def retraso(self, ahora):
+        """Segundos de atraso del chequeo más vencido (0 si el monitor va al día)"""
+        return max(0.0, ahora - min(self.proximo.values()))
+
+
+def resumir_log_red(entradas):
+    """Agrega el log de performance de Chrome (eventos Network.*) de una página.
+    
+    El tiempo de bloqueo es el 'blocked' de HAR: lo que cada petición espera
+    en cola antes de resolver DNS, conectar o enviarse.
+    """
+    recursos = {}
+    peticiones = 0
+    
+    for entrada in entradas:
+        try:
+            mensaje = json.loads(entrada["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+        metodo, params = mensaje.get("method"), mensaje.get("params", {})
+        
+        if metodo == "Network.requestWillBeSent":
+            peticiones += 1
+            recurso = recursos.setdefault(params["requestId"], {"bytes": 0, "bloqueo_ms": 0.0})
+            recurso["url"] = params["request"]["url"]
+            recurso["inicio"] = params["timestamp"]
+        elif metodo == "Network.responseReceived":
+            timing = params["response"].get("timing") or {}
+            fases = [timing.get(fase, -1) for fase in ("dnsStart", "connectStart", "sendStart")]
+            bloqueo = next((valor for valor in fases if valor >= 0), 0.0)
+            recursos.setdefault(params["requestId"], {"bytes": 0, "bloqueo_ms": 0.0})["bloqueo_ms"] = bloqueo
+        elif metodo == "Network.loadingFinished":
+            recurso = recursos.setdefault(params["requestId"], {"bytes": 0, "bloqueo_ms": 0.0})
+            recurso["bytes"] = params.get("encodedDataLength", 0)
+            recurso["fin"] = params["timestamp"]
+    
+    for recurso in recursos.values():
+        if "inicio" in recurso and "fin" in recurso:
+            recurso["duracion_ms"] = round((recurso["fin"] - recurso["inicio"]) * 1000, 2)
+    
+    def detalle(recurso):
+        return {"url": recurso.get("url"), "bytes": recurso["bytes"], "duracion_ms": recurso.get("duracion_ms")}
+    
+    return {
+        "bytes_transferidos": sum(r["bytes"] for r in recursos.values()),
+        "peticiones": peticiones,
+        "tiempo_bloqueo_ms": round(sum(r["bloqueo_ms"] for r in recursos.values()), 2),
+        "recursos_mas_pesados": [detalle(r) for r in sorted(recursos.values(), key=lambda r: r["bytes"], reverse=True)[:3]],
+        "recursos_mas_lentos": [detalle(r) for r in sorted(recursos.values(), key=lambda r: r.get("duracion_ms", 0), reverse=True)[:3]]
+    }
+
+
+def intervalo_wilson(exitos, total, z=1.96):
+    """Intervalo de confianza de Wilson (95% por defecto) para una proporción"""
+    if total == 0:
+        return 0.0, 1.0
+    p = exitos / total
+    denominador = 1 + z * z / total
+    centro = (p + z * z / (2 * total)) / denominador
+    margen = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denominador
+    return max(0.0, centro - margen), min(1.0, centro + margen)
+
+
+class EvaluadorSalud:
+    """Decide si el sitio está UP o DOWN a partir de ráfagas de sondeos concurrentes.
+    
+    Cada evaluación aplica el test secuencial de Wald (SPRT) entre una tasa de
+    fallo sana y una de caída, enviando ráfagas hasta decidir o agotar el tope.
+    El estado confirmado solo cambia tras CONFIRMACIONES_HEALTH decisiones
+    consecutivas en el mismo sentido (histéresis), lo que elimina el flapping
+    causado por fallos aislados.
+    """
+    
+    def __init__(self, sondear, tamano_rafaga=TAMANO_RAFAGA_HEALTH, max_rafagas=MAX_RAFAGAS_HEALTH,
+                 tasa_sana=TASA_FALLO_SANA, tasa_caida=TASA_FALLO_CAIDA,
+                 alfa=ALFA_HEALTH, beta=BETA_HEALTH, confirmaciones=CONFIRMACIONES_HEALTH,
+                 max_historial=MAX_HISTORIAL):
+        self.sondear = sondear
+        self.tamano_rafaga = tamano_rafaga
+        self.max_rafagas = max_rafagas
+        self.confirmaciones = confirmaciones
+        # Aporte de cada muestra a la razón de log-verosimilitud (caída vs. sana)
+        self.peso_fallo = math.log(tasa_caida / tasa_sana)
+        self.peso_exito = math.log((1 - tasa_caida) / (1 - tasa_sana))
+        self.limite_caida = math.log((1 - beta) / alfa)
+        self.limite_sana = math.log(beta / (1 - alfa))
+        self.estado = None  # estado confirmado: None (sin datos), "UP" o "DOWN"
+        self.candidato = None
+        self.decisiones_candidato = 0
+        self.transiciones = deque(maxlen=max_historial)
+    
+    def evaluar(self):
+        """Ejecuta una evaluación completa y devuelve decisión, estado y estadísticas"""
+        fallos = muestras = 0
+        razon = 0.0
+        decision = "INDETERMINADO"
+        
+        with ThreadPoolExecutor(max_workers=self.tamano_rafaga) as ejecutor:
+            for _ in range(self.max_rafagas):
+                rafaga = list(ejecutor.map(lambda _: self.sondear(), range(self.tamano_rafaga)))
+                muestras += len(rafaga)
+                fallos += rafaga.count(False)
+                razon = fallos * self.peso_fallo + (muestras - fallos) * self.peso_exito
+                
+                if razon >= self.limite_caida:
+                    decision = "DOWN"
+                    break
+                if razon <= self.limite_sana:
+                    decision = "UP"
+                    break
+        
+        anterior = self.estado
+        self._aplicar_histeresis(decision)
+        minimo, maximo = intervalo_wilson(fallos, muestras)
+        
+        return {
+            "decision": decision,
+            "estado": self.estado,
+            "transicion": anterior != self.estado,
+            "estado_anterior": anterior,
+            "muestras": muestras,
+            "fallos": fallos,
+            "tasa_fallo": fallos / muestras if muestras else 0.0,
+            "tasa_fallo_ic95": [round(minimo, 3), round(maximo, 3)],
+            "log_razon_verosimilitud": round(razon, 3)
+        }
+    
+    def _aplicar_histeresis(self, decision):
+        """Actualiza el estado confirmado según la última decisión"""
+        if decision == "INDETERMINADO":
+            return
+        if self.estado is None:
+            self._cambiar_estado(decision)
+        elif decision == self.estado:
+            self.candidato = None
+            self.decisiones_candidato = 0
+        else:
+            if decision != self.candidato:
+                self.candidato = decision
+                self.decisiones_candidato = 0
+            self.decisiones_candidato += 1
+            if self.decisiones_candidato >= self.confirmaciones:
+                self._cambiar_estado(decision)
+    
+    def _cambiar_estado(self, estado):
+        self.transiciones.append({
+            "desde": self.estado,
+            "hacia": estado,
+            "timestamp": datetime.now().isoformat()
+        })
+        self.estado = estado
+        self.candidato = None
+        self.decisiones_candidato = 0
+
 
 class MonitoreoZhaoChi:
     """Clase principal para monitoreo del sitio Zhao Chi"""
     
-    def __init__(self, url_base=URL_BASE):
+    def __init__(self, url_base=URL_BASE, max_historial=MAX_HISTORIAL, presupuestos=None):
         self.url_base = url_base
+        self.presupuestos = {**PRESUPUESTOS_PAGINA, **(presupuestos or {})}
+        # Historial de peso por página (línea base para detectar regresiones)
+        self.pesos_pagina = {}
         self.driver = None
-        self.resultados = []
-        self.alertas = []
+        # Sesión propia del journey sintético, para no mezclarse con carritos reales
+        self.session_sintetica = f"sintetico-{uuid.uuid4().hex[:12]}"
+        # Historial acotado para que el monitor pueda correr por días
+        self.resultados = deque(maxlen=max_historial)
+        self.alertas = deque(maxlen=max_historial)
         self.metricas = {
-            "tiempos_carga": [],
+            "tiempos_carga": deque(maxlen=max_historial),
             "errores_detectados": 0,
-            "paginas_monitore adas": 0,
-            "ultima_ejecucion": None
+            "paginas_monitoreadas": 0,
+            "ciclos_totales": 0,
+            "alertas_totales": 0,
+            "ultima_ejecucion": None,
+            "heartbeat": None,
+            "retraso_segundos": 0.0,
+            "retraso_max_segundos": 0.0
         }
+        self.detener = threading.Event()
+        self.interrumpible = False  # True mientras monitoreo_continuo puede cortarse con SIGTERM
+        self.evaluador_salud = EvaluadorSalud(self._sondear_health, max_historial=max_historial)
     
     def iniciar_navegador(self):
         """Inicializa el navegador Chrome para monitoreo"""
@@ -46,6 +321,8 @@ class MonitoreoZhaoChi:
             options.add_argument('--headless')  # Modo sin interfaz gráfica
             options.add_argument('--disable-gpu')
             options.add_argument('--no-sandbox')
+            # Log de red para auditar el peso de cada página
+            options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
             
             # Buscar ChromeDriver
             chromedriver_path = self._buscar_chromedriver()
@@ -81,11 +358,74 @@ class MonitoreoZhaoChi:
         """Cierra el navegador"""
         if self.driver:
             self.driver.quit()
+            self.driver = None
             print("[CIERRE] Navegador cerrado")
     
+    def _obtener_server_timing(self):
+        """Lee el desglose Server-Timing (bd, pago, render, total) de la última navegación"""
+        try:
+            entradas = self.driver.execute_script(
+                "const nav = performance.getEntriesByType('navigation')[0];"
+                "return nav ? nav.serverTiming.map(e => [e.name, e.duration]) : [];"
+            )
+            # Duraciones en segundos, igual que tiempo_carga
+            return {nombre: duracion / 1000 for nombre, duracion in entradas}
+        except Exception:
+            return {}
+    
+    def _descartar_log_red(self):
+        """Vacía el log de performance para que la auditoría cubra solo la navegación siguiente"""
+        try:
+            self.driver.get_log('performance')
+        except Exception:
+            pass
+    
+    def _auditar_peso_pagina(self, chequeo):
+        """Resume el tráfico de red de la página actual y lo compara con su presupuesto"""
+        try:
+            peso = resumir_log_red(self.driver.get_log('performance'))
+        except Exception:
+            return {}
+        
+        historial = self.pesos_pagina.setdefault(chequeo, deque(maxlen=MUESTRAS_LINEA_BASE_PESO))
+        linea_base = statistics.median(p["bytes_transferidos"] for p in historial) if historial else None
+        historial.append(peso)
+        
+        presupuesto = self.presupuestos.get(chequeo, {})
+        excesos = [
+            (clave, valor, presupuesto[limite])
+            for clave, valor, limite in [
+                ("bytes transferidos", peso["bytes_transferidos"], "bytes"),
+                ("peticiones", peso["peticiones"], "peticiones"),
+                ("tiempo de bloqueo (ms)", peso["tiempo_bloqueo_ms"], "bloqueo_ms")
+            ]
+            if limite in presupuesto and valor > presupuesto[limite]
+        ]
+        for clave, valor, limite in excesos:
+            self._generar_alerta(
+                nivel="WARNING",
+                mensaje=f"Presupuesto excedido en {chequeo}: {clave} {valor} (límite: {limite})",
+                metrica=f"presupuesto_{chequeo}",
+                valor=valor
+            )
+        
+        if linea_base and peso["bytes_transferidos"] > linea_base * (1 + TOLERANCIA_REGRESION_PESO):
+            self._generar_alerta(
+                nivel="WARNING",
+                mensaje=(f"Regresión de peso en {chequeo}: {peso['bytes_transferidos']} bytes "
+                         f"(línea base: {linea_base:.0f} bytes)"),
+                metrica=f"regresion_peso_{chequeo}",
+                valor=peso["bytes_transferidos"]
+            )
+        
+        peso["presupuesto_excedido"] = [clave for clave, _, _ in excesos]
+        peso["linea_base_bytes"] = linea_base
+        return peso
+    
     def monitorear_disponibilidad(self):
         """Verifica si el sitio está disponible (up/down)"""
         print("\n[TEST] Monitoreando disponibilidad...")
+        self._descartar_log_red()
         inicio = time.time()
         
         try:
@@ -110,6 +450,8 @@ class MonitoreoZhaoChi:
                 "test": "Disponibilidad",
                 "estado": estado,
                 "tiempo_carga": tiempo_carga,
+                "server_timing": self._obtener_server_timing(),
+                "peso_pagina": self._auditar_peso_pagina("disponibilidad"),
                 "timestamp": datetime.now().isoformat(),
                 "url": self.url_base
             }
@@ -154,6 +496,7 @@ class MonitoreoZhaoChi:
     def monitorear_funcionalidad_busqueda(self):
         """Verifica que la funcionalidad de búsqueda funcione"""
         print("\n[TEST] Monitoreando funcionalidad de búsqueda...")
+        self._descartar_log_red()
         inicio = time.time()
         
         try:
@@ -183,6 +526,8 @@ class MonitoreoZhaoChi:
                         "test": "Funcionalidad Búsqueda",
                         "estado": "OK",
                         "tiempo_carga": tiempo_carga,
+                        "server_timing": self._obtener_server_timing(),
+                        "peso_pagina": self._auditar_peso_pagina("busqueda"),
                         "productos_encontrados": cantidad_productos,
                         "timestamp": datetime.now().isoformat()
                     }
@@ -229,6 +574,7 @@ class MonitoreoZhaoChi:
     def monitorear_carrito_compras(self):
         """Verifica que el carrito de compras funcione"""
         print("\n[TEST] Monitoreando funcionalidad del carrito...")
+        self._descartar_log_red()
         inicio = time.time()
         
         try:
@@ -259,6 +605,8 @@ class MonitoreoZhaoChi:
                 "test": "Funcionalidad Carrito",
                 "estado": "OK",
                 "tiempo_carga": tiempo_carga,
+                "server_timing": self._obtener_server_timing(),
+                "peso_pagina": self._auditar_peso_pagina("carrito"),
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -281,6 +629,7 @@ class MonitoreoZhaoChi:
     def monitorear_checkout(self):
         """Verifica que el proceso de checkout funcione"""
         print("\n[TEST] Monitoreando proceso de checkout...")
+        self._descartar_log_red()
         inicio = time.time()
         
         try:
@@ -310,6 +659,8 @@ class MonitoreoZhaoChi:
                 "test": "Proceso Checkout",
                 "estado": "OK",
                 "tiempo_carga": tiempo_carga,
+                "server_timing": self._obtener_server_timing(),
+                "peso_pagina": self._auditar_peso_pagina("checkout"),
                 "timestamp": datetime.now().isoformat()
             }
             
@@ -329,51 +680,150 @@ class MonitoreoZhaoChi:
                 "timestamp": datetime.now().isoformat()
             }
     
+    def _sondear_health(self):
+        """Un sondeo individual a /health: True si responde 200 y 'healthy'"""
+        try:
+            respuesta = self._peticion_http("GET", "/health")
+            return respuesta["status"] == 200 and json.loads(respuesta["contenido"]).get("status") == "healthy"
+        except Exception:
+            return False
+    
     def monitorear_health_endpoint(self):
-        """Verifica el endpoint de health check"""
+        """Evalúa el health check con ráfagas de sondeos y un test estadístico"""
         print("\n[TEST] Monitoreando health endpoint...")
         
+        evaluacion = self.evaluador_salud.evaluar()
+        resumen = (f"{evaluacion['fallos']}/{evaluacion['muestras']} fallos, "
+                   f"IC95% tasa de fallo {evaluacion['tasa_fallo_ic95'][0]:.0%}-{evaluacion['tasa_fallo_ic95'][1]:.0%}")
+        
+        if evaluacion["estado"] == "DOWN":
+            estado = "DOWN"
+            print(f"[CRITICAL] Health check: sistema caído ({resumen})")
+            if evaluacion["transicion"]:
+                self._generar_alerta(
+                    nivel="ERROR",
+                    mensaje=f"Health check confirma sistema unhealthy ({resumen})",
+                    metrica="health",
+                    valor=evaluacion["tasa_fallo"]
+                )
+            self.metricas["errores_detectados"] += 1
+        elif evaluacion["decision"] == "UP" and evaluacion["estado"] == "UP":
+            estado = "OK"
+            print(f"[OK] Health check: Sistema saludable ({resumen})")
+            if evaluacion["transicion"] and evaluacion["estado_anterior"] == "DOWN":
+                self._generar_alerta(
+                    nivel="INFO",
+                    mensaje=f"Health check: sistema recuperado ({resumen})",
+                    metrica="health",
+                    valor=evaluacion["tasa_fallo"]
+                )
+        else:
+            # Sin decisión o sospecha de caída aún no confirmada: sin alerta, solo se acelera el chequeo
+            estado = "WARNING"
+            print(f"[WARNING] Health check sin confirmar (decisión: {evaluacion['decision']}, {resumen})")
+        
+        return {
+            "test": "Health Check",
+            "estado": estado,
+            "evaluacion": evaluacion,
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    def _peticion_http(self, metodo, ruta, datos=None):
+        """Hace una petición HTTP con la sesión sintética y mide su duración"""
+        cuerpo = json.dumps(datos).encode('utf-8') if datos is not None else None
+        peticion = urllib.request.Request(f"{self.url_base}{ruta}", data=cuerpo, method=metodo)
+        peticion.add_header("Cookie", f"session_id={self.session_sintetica}")
+        peticion.add_header("X-Monitoreo-Sintetico", "1")
+        # Propagar una traza propia para poder buscar el paso en /api/trazas
+        trace_id = uuid.uuid4().hex
+        peticion.add_header("traceparent", f"00-{trace_id}-{uuid.uuid4().hex[:16]}-01")
+        if cuerpo is not None:
+            peticion.add_header("Content-Type", "application/json")
+        
+        inicio = time.time()
         try:
-            self.driver.get(f"{self.url_base}/health")
+            with urllib.request.urlopen(peticion, timeout=TIMEOUT_HTTP) as respuesta:
+                status, contenido, headers = respuesta.status, respuesta.read(), respuesta.headers
+        except urllib.error.HTTPError as e:
+            status, contenido, headers = e.code, e.read(), e.headers
+        tiempo = time.time() - inicio
+        
+        return {
+            "status": status,
+            "contenido": contenido,
+            "tiempo": tiempo,
+            "trace_id": trace_id,
+            "server_timing": parsear_server_timing(headers.get("Server-Timing"))
+        }
+    
+    def monitorear_journey_checkout(self):
+        """Recorre producto -> agregar al carrito -> carrito -> pago con una misma sesión"""
+        print("\n[TEST] Monitoreando journey transaccional de checkout...")
+        pasos = []
+        
+        try:
+            pasos_journey = [
+                ("producto", "GET", f"/producto/{PRODUCTO_JOURNEY}", None),
+                ("agregar_carrito", "POST", "/api/carrito/agregar", {"producto_id": PRODUCTO_JOURNEY, "cantidad": 1}),
+                ("carrito", "GET", "/carrito", None),
+                ("pago", "POST", "/checkout", {})
+            ]
             
-            # Obtener el contenido JSON
-            body = self.driver.find_element(By.TAG_NAME, "body").text
+            for nombre, metodo, ruta, datos in pasos_journey:
+                respuesta = self._peticion_http(metodo, ruta, datos)
+                pasos.append({
+                    "paso": nombre,
+                    "status": respuesta["status"],
+                    "tiempo": respuesta["tiempo"],
+                    "trace_id": respuesta["trace_id"],
+                    "server_timing": respuesta["server_timing"]
+                })
+                print(f"     {nombre}: {respuesta['tiempo']:.2f}s (HTTP {respuesta['status']})")
+                
+                if respuesta["status"] != 200:
+                    raise RuntimeError(f"Paso '{nombre}' respondió HTTP {respuesta['status']}")
             
-            if "healthy" in body:
-                print("[OK] Health check: Sistema saludable")
-                return {
-                    "test": "Health Check",
-                    "estado": "OK",
-                    "respuesta": body,
-                    "timestamp": datetime.now().isoformat()
-                }
-            else:
-                print("[WARNING] Health check reporta problemas")
+            # Validar la orden generada por el último paso
+            orden = json.loads(respuesta["contenido"]).get("numero_orden", "")
+            if not re.fullmatch(r"ZC-\d{5}", orden):
+                raise RuntimeError(f"Número de orden inválido: {orden!r}")
+            
+            tiempo_total = sum(p["tiempo"] for p in pasos)
+            print(f"[OK] Journey completo - Orden {orden} en {tiempo_total:.2f}s")
+            
+            if tiempo_total > TIEMPO_MAX_CARGA:
+                paso_lento = max(pasos, key=lambda p: p["tiempo"])
                 self._generar_alerta(
                     nivel="WARNING",
-                    mensaje="Health check reporta sistema unhealthy",
-                    metrica="health",
-                    valor=0
+                    mensaje=f"Journey de compra lento: {tiempo_total:.2f}s (paso más lento: {paso_lento['paso']})",
+                    metrica="tiempo_journey_checkout",
+                    valor=tiempo_total
                 )
-                return {
-                    "test": "Health Check",
-                    "estado": "WARNING",
-                    "respuesta": body,
-                    "timestamp": datetime.now().isoformat()
-                }
-                
+            
+            return {
+                "test": "Journey Checkout",
+                "estado": "OK",
+                "tiempo_carga": tiempo_total,
+                "numero_orden": orden,
+                "pasos": pasos,
+                "timestamp": datetime.now().isoformat()
+            }
+            
         except Exception as e:
-            print(f"[ERROR] Health endpoint no responde: {str(e)}")
+            print(f"[ERROR] Error en journey de checkout: {str(e)}")
             self._generar_alerta(
-                nivel="ERROR",
-                mensaje="Health endpoint no accesible",
-                metrica="health",
+                nivel="CRITICAL",
+                mensaje=f"Journey de compra NO FUNCIONA - Pérdida de ventas: {str(e)}",
+                metrica="funcionalidad_journey_checkout",
                 valor=0
             )
+            self.metricas["errores_detectados"] += 1
             return {
-                "test": "Health Check",
+                "test": "Journey Checkout",
                 "estado": "ERROR",
                 "error": str(e),
+                "pasos": pasos,
                 "timestamp": datetime.now().isoformat()
             }
     
@@ -388,6 +838,7 @@ class MonitoreoZhaoChi:
         }
         
         self.alertas.append(alerta)
+        self.metricas["alertas_totales"] += 1
         
         # Imprimir con formato según el nivel
         simbolo = {
@@ -399,48 +850,63 @@ class MonitoreoZhaoChi:
         
         print(f"{simbolo} {mensaje}")
     
-    def ejecutar_ciclo_monitoreo(self):
-        """Ejecuta un ciclo completo de monitoreo"""
+    def _pruebas_disponibles(self):
+        """Chequeos del ciclo, en el orden en que se ejecutan"""
+        return {
+            "disponibilidad": self.monitorear_disponibilidad,
+            "busqueda": self.monitorear_funcionalidad_busqueda,
+            "carrito": self.monitorear_carrito_compras,
+            "checkout": self.monitorear_checkout,
+            "journey_checkout": self.monitorear_journey_checkout,
+            "health": self.monitorear_health_endpoint
+        }
+    
+    def ejecutar_ciclo_monitoreo(self, chequeos=None):
+        """Ejecuta un ciclo de monitoreo (todos los chequeos o solo los indicados)"""
         print("\n" + "=" * 70)
         print("INICIANDO CICLO DE MONITOREO")
         print(f"Fecha/Hora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("=" * 70)
         
-        if not self.iniciar_navegador():
-            print("[ERROR] No se pudo iniciar el navegador. Abortando monitoreo.")
-            return None
+        # Disponibilidad, búsqueda, carrito, checkout, journey de compra y health check
+        pruebas = self._pruebas_disponibles()
+        if chequeos is not None:
+            pruebas = {nombre: prueba for nombre, prueba in pruebas.items() if nombre in chequeos}
+        
+        # El navegador solo se inicia si hay chequeos que lo usen; los HTTP corren igual sin él
+        navegador_disponible = True
+        if any(nombre not in CHEQUEOS_HTTP for nombre in pruebas):
+            navegador_disponible = self.iniciar_navegador()
+            if not navegador_disponible:
+                print("[ERROR] No se pudo iniciar el navegador. Se omiten los chequeos de navegador.")
         
         try:
-            # Ejecutar todas las pruebas
             resultados_ciclo = {
                 "inicio": datetime.now().isoformat(),
                 "pruebas": []
             }
             
-            # 1. Disponibilidad
-            resultados_ciclo["pruebas"].append(self.monitorear_disponibilidad())
-            time.sleep(1)
-            
-            # 2. Búsqueda
-            resultados_ciclo["pruebas"].append(self.monitorear_funcionalidad_busqueda())
-            time.sleep(1)
-            
-            # 3. Carrito
-            resultados_ciclo["pruebas"].append(self.monitorear_carrito_compras())
-            time.sleep(1)
-            
-            # 4. Checkout
-            resultados_ciclo["pruebas"].append(self.monitorear_checkout())
-            time.sleep(1)
-            
-            # 5. Health Check
-            resultados_ciclo["pruebas"].append(self.monitorear_health_endpoint())
+            for i, (nombre, prueba) in enumerate(pruebas.items()):
+                if i > 0:
+                    time.sleep(1)
+                if navegador_disponible or nombre in CHEQUEOS_HTTP:
+                    resultado = prueba()
+                else:
+                    resultado = {
+                        "test": nombre,
+                        "estado": "ERROR",
+                        "error": "Navegador no disponible",
+                        "timestamp": datetime.now().isoformat()
+                    }
+                resultado["chequeo"] = nombre
+                resultados_ciclo["pruebas"].append(resultado)
             
             resultados_ciclo["fin"] = datetime.now().isoformat()
-            resultados_ciclo["alertas_generadas"] = len(self.alertas)
+            resultados_ciclo["alertas_generadas"] = self.metricas["alertas_totales"]
             
             # Guardar resultados
             self.resultados.append(resultados_ciclo)
+            self.metricas["ciclos_totales"] += 1
             self.metricas["ultima_ejecucion"] = datetime.now().isoformat()
             
             # Mostrar resumen
@@ -483,8 +949,15 @@ class MonitoreoZhaoChi:
         
         print("=" * 70)
     
-    def generar_reporte(self):
-        """Genera un reporte completo en JSON"""
+    def _actualizar_heartbeat(self, controlador, ahora):
+        """Heartbeat y retraso: si el retraso crece, el monitor no alcanza su propio ritmo"""
+        retraso = controlador.retraso(ahora)
+        self.metricas["heartbeat"] = datetime.now().isoformat()
+        self.metricas["retraso_segundos"] = retraso
+        self.metricas["retraso_max_segundos"] = max(self.metricas["retraso_max_segundos"], retraso)
+    
+    def generar_reporte(self, nombre_archivo=None):
+        """Genera un reporte completo en JSON (por defecto con nombre fechado)"""
         if not self.metricas["tiempos_carga"]:
             promedio_tiempo = 0
             min_tiempo = 0
@@ -497,59 +970,117 @@ class MonitoreoZhaoChi:
         reporte = {
             "fecha_generacion": datetime.now().isoformat(),
             "resumen": {
-                "total_ciclos": len(self.resultados),
+                "total_ciclos": self.metricas["ciclos_totales"],
                 "paginas_monitoreadas": self.metricas["paginas_monitoreadas"],
                 "errores_detectados": self.metricas["errores_detectados"],
-                "alertas_totales": len(self.alertas)
+                "alertas_totales": self.metricas["alertas_totales"]
+            },
+            "estado_monitor": {
+                "heartbeat": self.metricas["heartbeat"],
+                "retraso_segundos": round(self.metricas["retraso_segundos"], 2),
+                "retraso_max_segundos": round(self.metricas["retraso_max_segundos"], 2)
             },
             "rendimiento": {
                 "tiempo_promedio_carga": f"{promedio_tiempo:.2f}s",
                 "tiempo_min_carga": f"{min_tiempo:.2f}s",
                 "tiempo_max_carga": f"{max_tiempo:.2f}s"
             },
-            "alertas_recientes": self.alertas[-10:] if self.alertas else [],
-            "ultimos_resultados": self.resultados[-5:] if self.resultados else []
+            "peso_paginas": {
+                chequeo: {
+                    "ultimo": historial[-1],
+                    "presupuesto": self.presupuestos.get(chequeo, {})
+                }
+                for chequeo, historial in self.pesos_pagina.items()
+            },
+            "alertas_recientes": list(self.alertas)[-10:],
+            "ultimos_resultados": list(self.resultados)[-5:]
         }
         
-        # Guardar en archivo
-        nombre_archivo = f"reporte_monitoreo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(nombre_archivo, 'w', encoding='utf-8') as f:
+        # Guardar en archivo (escritura atómica: un corte a mitad no deja el reporte a medias)
+        if nombre_archivo is None:
+            nombre_archivo = f"reporte_monitoreo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        temporal = f"{nombre_archivo}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
             json.dump(reporte, f, indent=2, ensure_ascii=False)
+        os.replace(temporal, nombre_archivo)
         
         print(f"\n[GUARDADO] Reporte generado: {nombre_archivo}")
         return reporte
     
-    def monitoreo_continuo(self, duracion_minutos=60):
-        """Ejecuta monitoreo continuo por un período determinado"""
+    def monitoreo_continuo(self, duracion_minutos=60, intervalo_checkpoint=None,
+                           archivo_checkpoint=None):
+        """Ejecuta monitoreo continuo por un período determinado (None = sin límite).
+        
+        Con intervalo_checkpoint el reporte se reescribe periódicamente en
+        archivo_checkpoint, no solo al terminar.
+        """
         print("=" * 70)
         print("MONITOREO CONTINUO INICIADO")
-        print(f"Duración: {duracion_minutos} minutos")
-        print(f"Intervalo: {INTERVALO_MONITOREO} segundos entre ciclos")
+        print(f"Duración: {'sin límite' if duracion_minutos is None else f'{duracion_minutos} minutos'}")
+        print(f"Intervalo: {INTERVALO_MONITOREO} segundos entre ciclos "
+              f"(adaptativo hasta {INTERVALO_MINIMO_MONITOREO}s ante degradación)")
         print("Presiona Ctrl+C para detener el monitoreo")
         print("=" * 70)
         
-        tiempo_fin = datetime.now() + timedelta(minutes=duracion_minutos)
+        if duracion_minutos is None:
+            tiempo_fin = datetime.max
+        else:
+            tiempo_fin = datetime.now() + timedelta(minutes=duracion_minutos)
         ciclo_numero = 1
+        controlador = ControladorFrecuencia(self._pruebas_disponibles())
+        proximo_checkpoint = time.monotonic() + (intervalo_checkpoint or 0)
         
+        self.interrumpible = True
         try:
-            while datetime.now() < tiempo_fin:
+            while datetime.now() < tiempo_fin and not self.detener.is_set():
+                ahora = time.monotonic()
+                pendientes = controlador.chequeos_pendientes(ahora)
+                self._actualizar_heartbeat(controlador, ahora)
+                
                 print(f"\n\n{'#' * 70}")
-                print(f"CICLO #{ciclo_numero}")
+                print(f"CICLO #{ciclo_numero} - Chequeos: {', '.join(pendientes)}")
                 print(f"{'#' * 70}")
                 
-                self.ejecutar_ciclo_monitoreo()
+                resultados_ciclo = self.ejecutar_ciclo_monitoreo(chequeos=pendientes)
                 ciclo_numero += 1
                 
+                ahora = time.monotonic()
+                for resultado in resultados_ciclo["pruebas"]:
+                    intervalo = controlador.registrar(resultado["chequeo"], resultado, ahora)
+                    if intervalo < INTERVALO_MONITOREO:
+                        print(f"[ADAPTATIVO] {resultado['chequeo']}: próximo chequeo en {intervalo:.0f}s")
+                
                 if datetime.now() < tiempo_fin:
-                    print(f"\n[ESPERA] Próximo ciclo en {INTERVALO_MONITOREO} segundos...")
-                    time.sleep(INTERVALO_MONITOREO)
+                    espera = controlador.espera_siguiente(time.monotonic())
+                    print(f"\n[ESPERA] Próximo ciclo en {espera:.0f} segundos...")
+                
+                # Esperar al próximo chequeo escribiendo los checkpoints que venzan mientras tanto
+                while not self.detener.is_set():
+                    ahora = time.monotonic()
+                    if intervalo_checkpoint and ahora >= proximo_checkpoint:
+                        self._actualizar_heartbeat(controlador, ahora)
+                        self.generar_reporte(archivo_checkpoint)
+                        proximo_checkpoint = ahora + intervalo_checkpoint
+                    
+                    espera = controlador.espera_siguiente(time.monotonic())
+                    restante_fin = (tiempo_fin - datetime.now()).total_seconds()
+                    if espera <= 0 or restante_fin <= 0:
+                        break
+                    espera = min(espera, restante_fin)
+                    if intervalo_checkpoint:
+                        espera = min(espera, max(0.0, proximo_checkpoint - time.monotonic()))
+                    self.detener.wait(espera)
                     
         except KeyboardInterrupt:
             print("\n\n[INTERRUPCIÓN] Monitoreo detenido por el usuario")
+        finally:
+            # A partir de aquí una señal tardía no debe interrumpir el reporte final
+            self.interrumpible = False
+            self.cerrar_navegador()
         
         # Generar reporte final
         print("\n[FINALIZANDO] Generando reporte final...")
-        self.generar_reporte()
+        self.generar_reporte(archivo_checkpoint)
         print("\n[COMPLETADO] Monitoreo finalizado")
 
 
@@ -604,5 +1135,68 @@ def main():
     print("\n[FIN] Programa terminado")
 
 
+def parsear_argumentos(argv=None):
+    """Argumentos de línea de comandos para el modo daemon"""
+    parser = argparse.ArgumentParser(description="Monitoreo Zhao Chi E-Commerce")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Ejecuta sin menú interactivo (para supervisores como systemd)")
+    parser.add_argument('--config', help="Archivo JSON con la configuración del daemon")
+    parser.add_argument('--url', help=f"URL base del sitio (por defecto {URL_BASE})")
+    parser.add_argument('--duracion', type=int,
+                        help="Duración en minutos (por defecto sin límite)")
+    parser.add_argument('--intervalo-checkpoint', type=int,
+                        help=f"Segundos entre reportes parciales (por defecto {INTERVALO_CHECKPOINT})")
+    parser.add_argument('--archivo-checkpoint',
+                        help=f"Ruta del reporte parcial (por defecto {ARCHIVO_CHECKPOINT})")
+    parser.add_argument('--max-historial', type=int,
+                        help=f"Máximo de ciclos y alertas en memoria (por defecto {MAX_HISTORIAL})")
+    return parser.parse_args(argv)
+
+
+def ejecutar_daemon(args):
+    """Modo daemon: sin input(), con checkpoints periódicos y detención limpia con SIGTERM"""
+    config = {
+        "url": URL_BASE,
+        "duracion": None,
+        "intervalo_checkpoint": INTERVALO_CHECKPOINT,
+        "archivo_checkpoint": ARCHIVO_CHECKPOINT,
+        "max_historial": MAX_HISTORIAL,
+        "presupuestos": None  # solo por archivo de configuración: {chequeo: {bytes, peticiones, bloqueo_ms}}
+    }
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config.update(json.load(f))
+    # La línea de comandos tiene prioridad sobre el archivo de configuración
+    for clave in config:
+        valor = getattr(args, clave, None)
+        if valor is not None:
+            config[clave] = valor
+    
+    monitor = MonitoreoZhaoChi(url_base=config["url"], max_historial=config["max_historial"],
+                               presupuestos=config["presupuestos"])
+    
+    def manejar_sigterm(signum, frame):
+        if monitor.detener.is_set():
+            return
+        print("\n[SEÑAL] SIGTERM recibido, deteniendo monitoreo...")
+        monitor.detener.set()
+        # Interrumpe un ciclo en curso (el navegador se cierra en los bloques finally),
+        # pero nunca el reporte final
+        if monitor.interrumpible:
+            raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, manejar_sigterm)
+    
+    monitor.monitoreo_continuo(
+        duracion_minutos=config["duracion"],
+        intervalo_checkpoint=config["intervalo_checkpoint"],
+        archivo_checkpoint=config["archivo_checkpoint"]
+    )
+
+
 if __name__ == '__main__':
-    main()
+    argumentos = parsear_argumentos()
+    if argumentos.daemon:
+        ejecutar_daemon(argumentos)
+    else:
+        main()
@@ -3,9 +3,14 @@ Sitio Web Simulado - Zhao Chi E-Commerce
 Sistema web básico para probar el monitoreo
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template as flask_render_template, request, jsonify, g
+import math
 import time
 import random
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
 
 app = Flask(__name__)
@@ -22,8 +27,13 @@ PRODUCTOS = [
     {"id": 8, "nombre": "RAM Corsair 16GB", "precio": 59990, "stock": 45, "categoria": "Componentes"}
 ]
 
-# Carrito de compras en memoria
+PRODUCTOS_POR_ID = {p['id']: p for p in PRODUCTOS}
+
+# Carrito de compras en memoria: session_id -> {"items": {producto_id: item}, "subtotal", "unidades"}
+# El subtotal y las unidades se mantienen en cada modificación en vez de recalcularse al mostrar
 carritos = {}
+lock_carritos = threading.Lock()
+MAX_LINEAS_LOTE = 50  # líneas aceptadas por /api/carrito/lote
 
 # Estadísticas de rendimiento
 estadisticas = {
@@ -31,23 +41,233 @@ estadisticas = {
     "productos_vistos": 0,
     "agregados_al_carrito": 0,
     "compras": 0,
+    # Tráfico del monitor sintético (journey de checkout), separado del tráfico real
+    "agregados_sinteticos": 0,
+    "compras_sinteticas": 0,
     "tiempo_respuesta_promedio": []
 }
 
+# Trazas por petición (ring buffers en memoria)
+UMBRAL_TRAZA_LENTA = 1.0  # segundos; las trazas lentas o con error se guardan siempre
+TASA_MUESTREO_TRAZAS = 0.1  # fracción de trazas normales que se guardan
+MAX_TRAZAS = 200  # capacidad de cada buffer
+
+trazas_relevantes = deque(maxlen=MAX_TRAZAS)  # lentas o con error (muestreo por cola)
+trazas_muestreadas = deque(maxlen=MAX_TRAZAS)  # muestra de trazas normales
+
+# Header W3C traceparent: version-trace_id-span_id-flags
+PATRON_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+# Control de admisión por ruta: (concurrencia, máximo en cola, plazo en segundos)
+LIMITES_RUTA = {
+    "health_check": (4, 8, 1.0),
+    "checkout": (4, 8, 5.0),
+    "agregar_al_carrito": (8, 16, 3.0),
+    "simular_carga": (2, 2, 1.0)
+}
+LIMITE_RUTA_DEFECTO = (8, 16, 3.0)
+# Concurrencia y cola compartidas por todas las rutas de navegación
+LIMITE_NAVEGACION = (16, 32)
+# Carril prioritario: no compiten con la navegación por cupos
+RUTAS_PRIORITARIAS = {"health_check", "checkout"}
+# Observabilidad y estáticos: nunca se descartan
+RUTAS_SIN_ADMISION = {"get_estadisticas", "get_trazas", "static"}
+
+
+class CompuertaAdmision:
+    """Limita la concurrencia de un grupo de peticiones con una cola de espera acotada.
+    
+    Si no hay cupo libre, una petición se descarta de inmediato cuando la cola
+    está llena o cuando la espera estimada más su propio tiempo de servicio
+    (ambos según el promedio) supera su plazo; si no, espera un cupo como máximo
+    hasta el plazo menos el tiempo de servicio, para terminar dentro de él.
+    """
+    
+    def __init__(self, limite, max_cola):
+        self.limite = limite
+        self.max_cola = max_cola
+        self.condicion = threading.Condition()
+        self.activos = 0
+        self.en_cola = 0
+        self.admitidas = 0
+        self.rechazadas = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+        self.servicio_promedio = 0.05  # segundos, promedio móvil exponencial
+    
+    def espera_estimada(self):
+        """Segundos que esperaría una petición que llega ahora"""
+        return (self.en_cola + 1) * self.servicio_promedio / self.limite
+    
+    def admitir(self, plazo):
+        """Ocupa un cupo antes del plazo; devuelve False si la petición debe descartarse"""
+        inicio = time.perf_counter()
+        with self.condicion:
+            if self.activos >= self.limite:
+                espera_maxima = plazo - self.servicio_promedio
+                if self.en_cola >= self.max_cola or self.espera_estimada() > espera_maxima:
+                    self.rechazadas += 1
+                    return False
+                
+                self.en_cola += 1
+                try:
+                    admitida = self.condicion.wait_for(lambda: self.activos < self.limite, timeout=espera_maxima)
+                finally:
+                    self.en_cola -= 1
+                if not admitida:
+                    self.rechazadas += 1
+                    return False
+            
+            self.activos += 1
+            self.admitidas += 1
+            espera = time.perf_counter() - inicio
+            self.espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+            return True
+    
+    def liberar(self, duracion=None):
+        """Libera el cupo y, si la petición fue atendida, actualiza el tiempo de servicio promedio"""
+        with self.condicion:
+            self.activos -= 1
+            if duracion is not None:
+                self.servicio_promedio = 0.8 * self.servicio_promedio + 0.2 * duracion
+            self.condicion.notify()
+    
+    def estado(self):
+        """Métricas de la compuerta para /api/estadisticas"""
+        return {
+            "limite": self.limite,
+            "activos": self.activos,
+            "en_cola": self.en_cola,
+            "admitidas": self.admitidas,
+            "rechazadas": self.rechazadas,
+            "espera_promedio_ms": round(self.espera_total / self.admitidas * 1000, 2) if self.admitidas else 0,
+            "espera_max_ms": round(self.espera_max * 1000, 2)
+        }
+
+
+compuerta_navegacion = CompuertaAdmision(*LIMITE_NAVEGACION)
+compuertas_ruta = {}
+
+
+def compuerta_de_ruta(endpoint):
+    """Compuerta propia de cada ruta, creada en su primera petición"""
+    compuerta = compuertas_ruta.get(endpoint)
+    if compuerta is None:
+        limite, max_cola, _ = LIMITES_RUTA.get(endpoint, LIMITE_RUTA_DEFECTO)
+        compuerta = compuertas_ruta.setdefault(endpoint, CompuertaAdmision(limite, max_cola))
+    return compuerta
+
+
+def es_sintetico():
+    """Indica si la petición proviene del monitor sintético"""
+    return request.headers.get('X-Monitoreo-Sintetico') == '1'
+
+
+def nuevo_id(bits):
+    """Genera un identificador hexadecimal de traza o span"""
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+@contextmanager
+def medir_fase(nombre):
+    """Mide una fase de la petición: la acumula para Server-Timing y la registra como span"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        fases = g.setdefault('fases', {})
+        fases[nombre] = fases.get(nombre, 0.0) + duracion
+        g.setdefault('spans', []).append({
+            "span_id": nuevo_id(64),
+            "nombre": nombre,
+            "inicio_ms": round((inicio - g.get('inicio_traza', inicio)) * 1000, 2),
+            "duracion_ms": round(duracion * 1000, 2)
+        })
+
 
 def simular_carga_bd():
     """Simula consulta a base de datos con latencia variable"""
-    # 80% del tiempo es rápido, 20% es lento
-    if random.random() < 0.8:
-        time.sleep(random.uniform(0.01, 0.05))  # 10-50ms
-    else:
-        time.sleep(random.uniform(0.5, 1.0))  # 500-1000ms (lento)
+    with medir_fase("bd"):
+        # 80% del tiempo es rápido, 20% es lento
+        if random.random() < 0.8:
+            time.sleep(random.uniform(0.01, 0.05))  # 10-50ms
+        else:
+            time.sleep(random.uniform(0.5, 1.0))  # 500-1000ms (lento)
+
+
+def simular_pago():
+    """Simula el procesamiento de pago con el proveedor externo (puede ser lento)"""
+    with medir_fase("pago"):
+        time.sleep(random.uniform(0.5, 2.0))
+
+
+def render_template(template, **contexto):
+    """Renderiza la plantilla midiendo el tiempo de la fase 'render'"""
+    with medir_fase("render"):
+        return flask_render_template(template, **contexto)
+
+
+def formatear_server_timing(fases, total):
+    """Construye el valor del header Server-Timing (duraciones en ms)"""
+    partes = [f"{nombre};dur={duracion*1000:.1f}" for nombre, duracion in fases.items()]
+    partes.append(f"total;dur={total*1000:.1f}")
+    return ", ".join(partes)
 
 
 @app.before_request
 def registrar_inicio():
-    """Registra el tiempo de inicio de cada petición"""
+    """Registra el tiempo de inicio de cada petición y abre su traza"""
     request.start_time = time.time()
+    g.inicio_traza = time.perf_counter()
+    
+    # Continuar la traza del llamador si envía traceparent; si no, iniciar una nueva
+    coincidencia = PATRON_TRACEPARENT.match(request.headers.get('traceparent', ''))
+    if coincidencia:
+        g.trace_id, g.span_padre = coincidencia.groups()
+    else:
+        g.trace_id, g.span_padre = nuevo_id(128), None
+    g.span_id = nuevo_id(64)
+
+
+@app.before_request
+def controlar_admision():
+    """Admite la petición o la descarta con 503 si no puede atenderse dentro de su plazo"""
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in RUTAS_SIN_ADMISION:
+        return None
+    
+    compuertas = [compuerta_de_ruta(endpoint)]
+    if endpoint not in RUTAS_PRIORITARIAS:
+        compuertas.insert(0, compuerta_navegacion)
+    
+    _, _, plazo = LIMITES_RUTA.get(endpoint, LIMITE_RUTA_DEFECTO)
+    vencimiento = time.perf_counter() + plazo
+    g.compuertas = []
+    
+    with medir_fase("cola"):
+        for compuerta in compuertas:
+            if not compuerta.admitir(max(0.0, vencimiento - time.perf_counter())):
+                g.rechazada = True
+                response = jsonify({"error": "Servicio sobrecargado, reintente más tarde"})
+                response.status_code = 503
+                response.headers["Retry-After"] = str(max(1, math.ceil(compuerta.espera_estimada())))
+                return response
+            g.compuertas.append(compuerta)
+    
+    g.inicio_servicio = time.perf_counter()
+    return None
+
+
+@app.teardown_request
+def liberar_admision(error=None):
+    """Libera los cupos ocupados por la petición, aun si terminó con excepción"""
+    # Una petición descartada en una compuerta posterior no fue atendida: no entra al promedio
+    inicio_servicio = g.get('inicio_servicio')
+    duracion = time.perf_counter() - inicio_servicio if inicio_servicio is not None else None
+    for compuerta in g.get('compuertas', []):
+        compuerta.liberar(duracion)
 
 
 @app.after_request
@@ -55,15 +275,55 @@ def registrar_fin(response):
     """Registra el tiempo de respuesta después de cada petición"""
     if hasattr(request, 'start_time'):
         tiempo_respuesta = time.time() - request.start_time
-        estadisticas["tiempo_respuesta_promedio"].append(tiempo_respuesta)
         
-        # Mantener solo las últimas 100 mediciones
-        if len(estadisticas["tiempo_respuesta_promedio"]) > 100:
-            estadisticas["tiempo_respuesta_promedio"] = estadisticas["tiempo_respuesta_promedio"][-100:]
+        # Los descartes se cuentan en la admisión; mezclarlos ocultaría la latencia real
+        if not g.get('rechazada'):
+            estadisticas["tiempo_respuesta_promedio"].append(tiempo_respuesta)
+            
+            # Mantener solo las últimas 100 mediciones
+            if len(estadisticas["tiempo_respuesta_promedio"]) > 100:
+                estadisticas["tiempo_respuesta_promedio"] = estadisticas["tiempo_respuesta_promedio"][-100:]
+        
+        # Desglose por fase (bd, pago, render) para que el monitor pueda atribuir la latencia
+        response.headers["Server-Timing"] = formatear_server_timing(g.get('fases', {}), tiempo_respuesta)
+    
+    if 'trace_id' in g:
+        response.headers["traceparent"] = f"00-{g.trace_id}-{g.span_id}-01"
+    g.status_respuesta = response.status_code
     
     return response
 
 
+@app.teardown_request
+def cerrar_traza(error=None):
+    """Guarda la traza de la petición; corre aun si la vista lanzó una excepción (modo debug incluido)"""
+    # Las peticiones descartadas se cuentan en la admisión; no desplazan trazas útiles del buffer
+    if 'trace_id' not in g or g.get('rechazada'):
+        return
+    status = 500 if error is not None else g.get('status_respuesta', 500)
+    registrar_traza(status, time.perf_counter() - g.inicio_traza)
+
+
+def registrar_traza(status, duracion):
+    """Guarda la traza de la petición actual aplicando muestreo por cola"""
+    relevante = status >= 500 or duracion >= UMBRAL_TRAZA_LENTA
+    if not relevante and random.random() >= TASA_MUESTREO_TRAZAS:
+        return
+    
+    traza = {
+        "trace_id": g.trace_id,
+        "span_id": g.span_id,
+        "span_padre": g.span_padre,
+        "metodo": request.method,
+        "ruta": request.path,
+        "status": status,
+        "duracion_ms": round(duracion * 1000, 2),
+        "timestamp": datetime.now().isoformat(),
+        "spans": g.get('spans', [])
+    }
+    (trazas_relevantes if relevante else trazas_muestreadas).append(traza)
+
+
 @app.route('/')
 def home():
     """Página principal"""
@@ -101,22 +361,64 @@ def detalle_producto(producto_id):
     return render_template('producto.html', producto=producto)
 
 
+def carrito_vacio():
+    """Estructura de un carrito nuevo"""
+    return {"items": {}, "subtotal": 0, "unidades": 0}
+
+
+def obtener_carrito(session_id):
+    """Carrito de la sesión (un carrito vacío si no existe, sin registrarlo)"""
+    return carritos.get(session_id) or carrito_vacio()
+
+
+def fijar_cantidad(carrito, producto, cantidad):
+    """Fija la cantidad de un producto en el carrito ajustando subtotal y unidades por diferencia"""
+    item = carrito["items"].get(producto['id'])
+    anterior = item['cantidad'] if item else 0
+    
+    if cantidad <= 0:
+        carrito["items"].pop(producto['id'], None)
+    elif item:
+        item['cantidad'] = cantidad
+    else:
+        carrito["items"][producto['id']] = {
+            'id': producto['id'],
+            'nombre': producto['nombre'],
+            'precio': producto['precio'],
+            'cantidad': cantidad
+        }
+    
+    diferencia = max(cantidad, 0) - anterior
+    carrito["subtotal"] += diferencia * producto['precio']
+    carrito["unidades"] += diferencia
+
+
+def resumen_carrito(carrito):
+    """Campos comunes de las respuestas de la API del carrito"""
+    return {
+        "items_en_carrito": len(carrito["items"]),
+        "unidades": carrito["unidades"],
+        "subtotal": carrito["subtotal"]
+    }
+
+
 @app.route('/carrito', methods=['GET'])
 def ver_carrito():
     """Ver carrito de compras"""
     estadisticas["visitas"] += 1
     session_id = request.cookies.get('session_id', 'default')
-    carrito = carritos.get(session_id, [])
+    carrito = obtener_carrito(session_id)
     
-    total = sum(item['precio'] * item['cantidad'] for item in carrito)
-    
-    return render_template('carrito.html', carrito=carrito, total=total)
+    return render_template('carrito.html', carrito=list(carrito["items"].values()), total=carrito["subtotal"])
 
 
 @app.route('/api/carrito/agregar', methods=['POST'])
 def agregar_al_carrito():
     """Agregar producto al carrito"""
-    estadisticas["agregados_al_carrito"] += 1
+    if es_sintetico():
+        estadisticas["agregados_sinteticos"] += 1
+    else:
+        estadisticas["agregados_al_carrito"] += 1
     simular_carga_bd()
     
     data = request.json
@@ -124,31 +426,90 @@ def agregar_al_carrito():
     cantidad = data.get('cantidad', 1)
     
     # Buscar producto
-    producto = next((p for p in PRODUCTOS if p['id'] == producto_id), None)
+    producto = PRODUCTOS_POR_ID.get(producto_id)
     if not producto:
         return jsonify({"error": "Producto no encontrado"}), 404
     
-    # Agregar al carrito
+    # Agregar al carrito (sumando si ya está)
     session_id = request.cookies.get('session_id', 'default')
-    if session_id not in carritos:
-        carritos[session_id] = []
+    with lock_carritos:
+        carrito = carritos.setdefault(session_id, carrito_vacio())
+        item_existente = carrito["items"].get(producto_id)
+        fijar_cantidad(carrito, producto, (item_existente['cantidad'] if item_existente else 0) + cantidad)
+        resumen = resumen_carrito(carrito)
+    
+    return jsonify({
+        "success": True,
+        "mensaje": "Producto agregado al carrito",
+        **resumen
+    })
+
+
+def es_entero(valor):
+    """Entero JSON estricto (excluye booleanos)"""
+    return isinstance(valor, int) and not isinstance(valor, bool)
+
+
+def linea_lote_valida(linea):
+    """Valida una línea de /api/carrito/lote antes de aplicar el lote"""
+    accion = linea.get('accion', 'agregar')
+    cantidad = linea.get('cantidad', 1)
+    if accion not in ('agregar', 'actualizar') or not es_entero(linea.get('producto_id')):
+        return False
+    if not es_entero(cantidad):
+        return False
+    return cantidad > 0 if accion == 'agregar' else cantidad >= 0
+
+
+@app.route('/api/carrito/lote', methods=['POST'])
+def agregar_lote_carrito():
+    """Agregar o actualizar varias líneas del carrito con una sola consulta a BD.
     
-    # Verificar si ya está en el carrito
-    item_existente = next((item for item in carritos[session_id] if item['id'] == producto_id), None)
-    if item_existente:
-        item_existente['cantidad'] += cantidad
+    Cuerpo: {"items": [{"producto_id": 1, "cantidad": 2, "accion": "agregar"}, ...]}
+    con accion "agregar" (suma, por defecto) o "actualizar" (fija la cantidad; 0 elimina).
+    El lote se valida completo antes de aplicarse: si una línea es inválida no se aplica ninguna.
+    """
+    data = request.get_json(silent=True)
+    lineas = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(lineas, list) or not lineas or not all(isinstance(linea, dict) for linea in lineas):
+        return jsonify({"error": "Se requiere una lista 'items' no vacía de objetos"}), 400
+    if len(lineas) > MAX_LINEAS_LOTE:
+        return jsonify({"error": f"Máximo {MAX_LINEAS_LOTE} líneas por lote"}), 400
+    
+    invalidas = [linea for linea in lineas if not linea_lote_valida(linea)]
+    if invalidas:
+        return jsonify({
+            "error": ("Líneas inválidas: 'producto_id' entero, 'accion' 'agregar' (cantidad entera > 0) "
+                      "o 'actualizar' (cantidad entera >= 0)"),
+            "items": invalidas
+        }), 400
+    no_encontrados = [linea['producto_id'] for linea in lineas if linea['producto_id'] not in PRODUCTOS_POR_ID]
+    if no_encontrados:
+        return jsonify({"error": "Producto no encontrado", "productos": no_encontrados}), 404
+    
+    # Solo los lotes válidos cuentan como agregados y pagan la consulta a BD
+    if es_sintetico():
+        estadisticas["agregados_sinteticos"] += len(lineas)
     else:
-        carritos[session_id].append({
-            'id': producto['id'],
-            'nombre': producto['nombre'],
-            'precio': producto['precio'],
-            'cantidad': cantidad
-        })
+        estadisticas["agregados_al_carrito"] += len(lineas)
+    simular_carga_bd()  # Una sola consulta para todo el lote
+    
+    session_id = request.cookies.get('session_id', 'default')
+    with lock_carritos:
+        carrito = carritos.setdefault(session_id, carrito_vacio())
+        for linea in lineas:
+            producto = PRODUCTOS_POR_ID[linea['producto_id']]
+            cantidad = linea.get('cantidad', 1)
+            if linea.get('accion', 'agregar') == 'agregar':
+                item_existente = carrito["items"].get(producto['id'])
+                cantidad += item_existente['cantidad'] if item_existente else 0
+            fijar_cantidad(carrito, producto, cantidad)
+        resumen = resumen_carrito(carrito)
     
     return jsonify({
         "success": True,
-        "mensaje": "Producto agregado al carrito",
-        "items_en_carrito": len(carritos[session_id])
+        "mensaje": f"{len(lineas)} líneas aplicadas al carrito",
+        **resumen
     })
 
 
@@ -158,21 +519,23 @@ def checkout():
     if request.method == 'GET':
         estadisticas["visitas"] += 1
         session_id = request.cookies.get('session_id', 'default')
-        carrito = carritos.get(session_id, [])
-        total = sum(item['precio'] * item['cantidad'] for item in carrito)
-        return render_template('checkout.html', carrito=carrito, total=total)
+        carrito = obtener_carrito(session_id)
+        return render_template('checkout.html', carrito=list(carrito["items"].values()), total=carrito["subtotal"])
     
     # POST - Procesar pago
-    estadisticas["compras"] += 1
+    if es_sintetico():
+        estadisticas["compras_sinteticas"] += 1
+    else:
+        estadisticas["compras"] += 1
     simular_carga_bd()
     
     # Simular procesamiento de pago (puede ser lento)
-    time.sleep(random.uniform(0.5, 2.0))
+    simular_pago()
     
     # Vaciar carrito
     session_id = request.cookies.get('session_id', 'default')
-    if session_id in carritos:
-        carritos[session_id] = []
+    with lock_carritos:
+        carritos.pop(session_id, None)
     
     return jsonify({
         "success": True,
@@ -198,6 +561,14 @@ def get_estadisticas():
         "productos_vistos": estadisticas["productos_vistos"],
         "agregados_carrito": estadisticas["agregados_al_carrito"],
         "compras_realizadas": estadisticas["compras"],
+        "admision": {
+            "navegacion": compuerta_navegacion.estado(),
+            "rutas": {endpoint: c.estado() for endpoint, c in list(compuertas_ruta.items())}
+        },
+        "sinteticas": {
+            "agregados_carrito": estadisticas["agregados_sinteticos"],
+            "compras_realizadas": estadisticas["compras_sinteticas"]
+        },
         "rendimiento": {
             "tiempo_respuesta_promedio": f"{promedio*1000:.2f}ms",
             "tiempo_respuesta_min": f"{minimo*1000:.2f}ms",
@@ -207,6 +578,28 @@ def get_estadisticas():
     })
 
 
+@app.route('/api/trazas')
+def get_trazas():
+    """Trazas recientes más lentas (parámetros: limite, ruta, min_ms)"""
+    limite = request.args.get('limite', 10, type=int)
+    ruta = request.args.get('ruta')
+    min_ms = request.args.get('min_ms', 0, type=float)
+    
+    trazas = [
+        t for t in list(trazas_relevantes) + list(trazas_muestreadas)
+        if t["duracion_ms"] >= min_ms and (ruta is None or t["ruta"] == ruta)
+    ]
+    trazas.sort(key=lambda t: t["duracion_ms"], reverse=True)
+    
+    return jsonify({
+        "trazas": trazas[:limite],
+        "total_relevantes": len(trazas_relevantes),
+        "total_muestreadas": len(trazas_muestreadas),
+        "umbral_lenta_ms": UMBRAL_TRAZA_LENTA * 1000,
+        "tasa_muestreo": TASA_MUESTREO_TRAZAS
+    })
+
+
 @app.route('/health')
 def health_check():
     """Health check para monitoreo"""
@@ -254,8 +647,10 @@ if __name__ == '__main__':
     print("  / - Página principal")
     print("  /productos - Catálogo")
     print("  /carrito - Ver carrito")
+    print("  /api/carrito/lote - Agregar varias líneas al carrito")
     print("  /checkout - Proceso de pago")
     print("  /api/estadisticas - Estadísticas del sistema")
+    print("  /api/trazas - Trazas más lentas recientes")
     print("  /health - Health check")
     print("  /simular-carga - Simular carga alta")
     print("  /simular-error - Simular errores")